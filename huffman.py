@@ -6,9 +6,74 @@
 #
 # https://videolectures.net/videos/mackay_course_04
 #
+import functools
 import heapq
+import importlib
 import math
-from collections import defaultdict, Counter
+import sys
+from collections import Counter
+from types import MappingProxyType
+
+# Codes up to this length are decoded with a single table lookup; longer codes
+# finish with a short walk down the tree.
+DECODE_TABLE_BITS = 12
+
+# Until a tree has its decode table, shorter streams are decoded by walking the
+# tree, which is faster than building the table (~15 us) for a few symbols.
+TABLE_DECODE_MIN_BITS = 1024
+
+# Streams of at least this many bits are decoded with the multi-symbol table,
+# which pays for its ~1 ms construction on longer inputs.
+MULTI_DECODE_MIN_BITS = 1 << 16
+
+# Shorter texts are counted with Counter, which is as fast when the input is
+# small and building the result dict dominates.
+NUMPY_MIN_LEN = 4096
+
+# Entropy of smaller distributions is computed in pure Python, which beats the
+# fixed overhead of building numpy arrays up to about a hundred symbols.
+NUMPY_ENTROPY_MIN_LEN = 128
+
+# encode_bytes compiles its loop for texts of at least this many symbols, and
+# decode_bytes for streams of at least this many bits; below that the pure
+# Python codec is as fast once the call overhead is counted.
+NUMBA_ENCODE_MIN_LEN = 4096
+NUMBA_DECODE_MIN_BITS = 4096
+
+# The compiled codec keeps up to 56 bits in a signed 64-bit window, refilled a
+# byte at a time whenever 48 or fewer are left, so codes must fit in 48 bits.
+NUMBA_MAX_CODE_LEN = 48
+
+
+@functools.cache
+def _import_optional(name):
+    """Import an optional dependency on first use, or None if it is missing."""
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+
+def count_freq(text):
+    """
+    Count symbol frequencies in text.
+
+    Uses numpy.bincount over the code points of a long str when numpy is
+    available, otherwise collections.Counter, so any iterable of symbols works.
+
+    Returns:
+        Counter: Mapping of symbols to their counts
+    """
+    np = None
+    if isinstance(text, str) and len(text) >= NUMPY_MIN_LEN:
+        np = _import_optional("numpy")
+    if np is None:
+        return Counter(text)
+    codepoints = np.frombuffer(
+        text.encode("utf-32-le", "surrogatepass"), dtype=np.uint32
+    )
+    counts = np.bincount(codepoints)
+    return Counter({chr(cp): int(counts[cp]) for cp in np.flatnonzero(counts)})
 
 
 def canonical_huffman_codes(symbols_with_lengths):
@@ -19,72 +84,305 @@ def canonical_huffman_codes(symbols_with_lengths):
         symbols_with_lengths: List of (symbol, code_length) tuples
 
     Returns:
-        dict: Mapping of symbols to their binary code strings
+        dict: Mapping of symbols to (code, length) pairs. As in DEFLATE,
+        symbols with length 0 are unused and get no code.
+
+    Raises:
+        ValueError: If a code length is negative
     """
 
-    # Sort by (length, symbol) as per canonical Huffman rules
-    sorted_symbols = sorted(symbols_with_lengths, key=lambda x: (x[1], x[0]))
+    # Codes are assigned in (length, symbol) order as per canonical Huffman
+    # rules - bucket by length, so only symbols of equal length are sorted.
+    max_len = max((length for _, length in symbols_with_lengths), default=0)
+    buckets = [[] for _ in range(max_len + 1)]
+    for symbol, length in symbols_with_lengths:
+        if length < 0:
+            # a negative index would silently wrap around to the longest codes
+            raise ValueError(f"Invalid code length {length} for symbol {symbol!r}")
+        buckets[length].append(symbol)
+
     code = 0
-    prev_len = 0
     codebook = {}
-    for symbol, length in sorted_symbols:
-        code <<= length - prev_len
-        codebook[symbol] = f"{code:0{length}b}"
-        code += 1
-        prev_len = length
+    for length in range(1, max_len + 1):
+        for symbol in sorted(buckets[length]):
+            codebook[symbol] = (code, length)
+            code += 1
+        code <<= 1
     return codebook
 
 
+def codes_to_strings(codebook):
+    """
+    Format a codebook of (code, length) pairs as bit strings.
+
+    Args:
+        codebook: dict mapping symbols to (code, length) pairs
+
+    Returns:
+        dict: Mapping of symbols to their binary code strings, e.g. {"a": "010"}
+    """
+    return {c: bin(code)[2:].zfill(length) for c, (code, length) in codebook.items()}
+
+
+def _pack_bits(bits):
+    """Pack a string of "0"/"1" into bytes, zero padding the last byte."""
+    if not bits:
+        return b""
+    nbytes = (len(bits) + 7) // 8
+    return (int(bits, 2) << (8 * nbytes - len(bits))).to_bytes(nbytes, "big")
+
+
+def _code_pair(symbol, code):
+    """Validate a codebook entry given as a (code, length) pair or a bit string."""
+    if type(code) is tuple and len(code) == 2:
+        value, length = code
+        if (
+            type(value) is int
+            and type(length) is int
+            and length > 0
+            and 0 <= value < 1 << length
+        ):
+            return code
+    elif type(code) is str and code and not code.strip("01"):
+        return int(code, 2), len(code)
+    raise ValueError(
+        f"Invalid code {code!r} for symbol {symbol!r}: "
+        "expected a (code, length) pair or a bit string"
+    )
+
+
+@functools.cache
+def _numba_codec():
+    """
+    Compile the packed codec loops on first use, so importing this module never
+    loads numba. Returns (_encode_numba, _decode_numba), or None if numba is
+    not installed.
+    """
+    numba = _import_optional("numba")
+    if numba is None:
+        return None
+    np = _import_optional("numpy")  # a numba dependency
+
+    @numba.njit(cache=True)
+    def _encode_numba(codepoints, code_ints, code_lens, bitlen):
+        out = np.zeros((bitlen + 7) // 8, np.uint8)
+        acc = 0
+        nbits = 0
+        pos = 0
+        for cp in codepoints:
+            length = code_lens[cp]
+            acc = (acc << length) | code_ints[cp]
+            nbits += length
+            while nbits >= 8:
+                nbits -= 8
+                out[pos] = (acc >> nbits) & 0xFF
+                pos += 1
+            acc &= (1 << nbits) - 1
+        if nbits:
+            out[pos] = (acc << (8 - nbits)) & 0xFF
+        return out
+
+    @numba.njit(cache=True)
+    def _decode_numba(
+        buf, bitlen, table_sym, table_len, table_bits, left, right, symbol, out
+    ):
+        """
+        Decode into out, returning the symbol count, or -1 for an invalid and
+        -2 for an incomplete stream. Table entries with table_sym < 0 hold a
+        flattened node id (or -1 if unused) in table_len, as in _lookup_table.
+        """
+        nbytes = (bitlen + 7) // 8
+        mask = (1 << table_bits) - 1
+        window = 0
+        avail = 0  # bits in window, including the padding of the last byte
+        remaining = bitlen  # input bits not yet decoded
+        pos = 0
+        n = 0
+        while remaining > 0:
+            while avail <= NUMBA_MAX_CODE_LEN and pos < nbytes:
+                window = (window << 8) | np.int64(buf[pos])
+                avail += 8
+                pos += 1
+            if avail >= table_bits:
+                i = (window >> (avail - table_bits)) & mask
+            else:
+                i = (window << (table_bits - avail)) & mask
+            sym = table_sym[i]
+            length = table_len[i]
+            if sym < 0:
+                node_id = length
+                length = table_bits
+                if node_id < 0:
+                    # unused entry: walk from the root to find where it breaks
+                    node_id = 0
+                    length = 0
+                while True:
+                    if length >= avail:
+                        return -2
+                    length += 1
+                    if (window >> (avail - length)) & 1:
+                        node_id = right[node_id]
+                    else:
+                        node_id = left[node_id]
+                    if node_id < 0:
+                        # leaving the tree past the end means a truncated code
+                        return -2 if length > remaining else -1
+                    if symbol[node_id] >= 0:
+                        break
+                sym = symbol[node_id]
+            if length > remaining:
+                return -2
+            out[n] = sym
+            n += 1
+            avail -= length
+            remaining -= length
+            window &= (1 << avail) - 1
+        return n
+
+    return _encode_numba, _decode_numba
+
+
+class _TreeCache:
+    """Codebook and the lookup tables derived from it, held by the root only."""
+
+    __slots__ = (
+        "codebook",
+        "keyset",
+        "encode_table",
+        "decode_table",
+        "multi_table",
+        "numba_tables",
+        "numba_decode_tables",
+    )
+
+    def __init__(self, codebook):
+        # a read-only copy, so the tables below cannot go stale
+        self.codebook = MappingProxyType(dict(codebook))
+        self.keyset = None
+        self.encode_table = None
+        self.decode_table = None
+        self.multi_table = None
+        self.numba_tables = None
+        self.numba_decode_tables = None
+
+
 class HuffmanNode:
+    __slots__ = ("freq", "char", "left", "right", "_cache")
+
     def __init__(self, char, freq: int):
         self.freq = freq
         self.char = char
         self.left = None
         self.right = None
-        self.codebook = None
+        self._cache = None
+
+    @property
+    def codebook(self):
+        """
+        Read-only mapping of symbols to (code, length) pairs. To change codes,
+        assign a new codebook rather than editing this one.
+        """
+        return None if self._cache is None else self._cache.codebook
+
+    @codebook.setter
+    def codebook(self, codebook):
+        # a new codebook invalidates all tables derived from the old one
+        self._cache = None if codebook is None else _TreeCache(codebook)
 
     @classmethod
     def from_freq(cls, freq_dict):
         if not freq_dict:
             raise ValueError("Frequency dictionary cannot be empty")
-        heap = [cls(char, freq) for char, freq in freq_dict.items()]
+        if len(freq_dict) <= 2:
+            # One or two symbols: the codes are known up front, skip the heap
+            (char, freq), *rest = freq_dict.items()
+            if not rest:
+                root = cls(char, freq)
+                root.codebook = {char: (0, 1)}
+                return root
+            char2, freq2 = rest[0]
+            if freq2 < freq:
+                # the rarer symbol goes left; ties keep insertion order
+                char, freq, char2, freq2 = char2, freq2, char, freq
+            root = cls(char=None, freq=freq + freq2)
+            root.left = cls(char, freq)
+            root.right = cls(char2, freq2)
+            root.codebook = {char: (0, 1), char2: (1, 1)}
+            return root
+
+        # Heap of (freq, order, node) - the unique insertion order breaks ties
+        # deterministically, so nodes themselves are never compared.
+        heap = [
+            (freq, i, cls(char, freq))
+            for i, (char, freq) in enumerate(freq_dict.items())
+        ]
         heapq.heapify(heap)
+        order = len(heap)
         while len(heap) > 1:
-            n1 = heapq.heappop(heap)
-            n2 = heapq.heappop(heap)
-            merged = cls(char=None, freq=n1.freq + n2.freq)
+            f1, _, n1 = heapq.heappop(heap)
+            f2, _, n2 = heapq.heappop(heap)
+            merged = cls(char=None, freq=f1 + f2)
             merged.left = n1
             merged.right = n2
-            heapq.heappush(heap, merged)
-        heap[0].generate_codes()
-        return heap[0]
+            heapq.heappush(heap, (merged.freq, order, merged))
+            order += 1
+        root = heap[0][2]
+        root.generate_codes()
+        return root
 
     @classmethod
     def from_codebook(cls, codebook):
+        """
+        Rebuild the tree from a codebook.
+
+        Args:
+            codebook: dict mapping symbols to (code, length) pairs, e.g.
+                {"a": (0b0, 1), "b": (0b10, 2)}, or to bit strings, e.g.
+                {"a": "0", "b": "10"}
+        """
         root = cls(None, 0)
-
+        pairs = {}
+        leaves = []
         for symbol, code in codebook.items():
+            pairs[symbol] = code, length = _code_pair(symbol, code)
             node = root
-            for bit in code:
-                if bit == "0":
-                    if node.left is None:
-                        node.left = cls(None, 0)
-                    node = node.left
+            bit = 1 << length
+            while bit > 1:
+                bit >>= 1
+                if code & bit:
+                    child = node.right
+                    if child is None:
+                        child = node.right = cls(None, 0)
                 else:
-                    if node.right is None:
-                        node.right = cls(None, 0)
-                    node = node.right
+                    child = node.left
+                    if child is None:
+                        child = node.left = cls(None, 0)
+                node = child
+            if node.char is not None or node.left is not None or node.right is not None:
+                # a repeated code, or a prefix of an earlier code
+                raise ValueError("Codebook is not prefix-free")
             node.char = symbol  # Assign symbol at leaf
-        root.codebook = codebook
+            leaves.append(node)
+        # an earlier code that is a prefix of a later one has gained children
+        if any(node.left is not None or node.right is not None for node in leaves):
+            raise ValueError("Codebook is not prefix-free")
+        root.codebook = pairs
         return root
 
+    @property
+    def codebook_str(self):
+        """Codebook with codes formatted as bit strings, see codes_to_strings."""
+        return codes_to_strings(self.codebook)
+
     def display_codes(self, freq):
-        print(f"Codebook ({len(self.codebook)})")
-        print("Symbol  cnt length  code")
-        for c in sorted(self.codebook):
-            print(
-                f"{c} ->   {freq[c]:4}  {len(self.codebook[c]):5}  {self.codebook[c]}"
-            )
+        codebook_str = self.codebook_str
+        lines = [f"Codebook ({len(self.codebook)})", "Symbol  cnt length  code"]
+        lines.extend(
+            f"{c} ->   {freq[c]:4}  {self.codebook[c][1]:5}  {codebook_str[c]}"
+            for c in sorted(self.codebook)
+        )
+        # One write for the whole table instead of a print per symbol
+        sys.stdout.write("\n".join(lines) + "\n")
 
     def __str__(self):
         if self.char is not None:
@@ -107,69 +405,365 @@ class HuffmanNode:
             if self.right:
                 self.right.pretty_print(indent + 1)
 
-    # node comparison - needed for heapq
-    def __lt__(self, other):
-        return self.freq < other.freq
-
     def generate_codes(self):
         if self.codebook is not None:
             return self.codebook
 
-        self.codebook = {}
+        codebook = {}
         if self.char is not None:
             # Edge case: tree with single node
-            self.codebook[self.char] = "0"
+            codebook[self.char] = (0, 1)
         else:
-            self._build_codes("", self.codebook)
-
-    def _build_codes(self, prefix, codebook):
-        if self.char is not None:
-            codebook[self.char] = prefix
-        else:
-            if self.left:
-                self.left._build_codes(prefix + "0", codebook)
-            if self.right:
-                self.right._build_codes(prefix + "1", codebook)
+            self._build_codes(codebook)
+        self.codebook = codebook
+        return self.codebook
+
+    def _build_codes(self, codebook):
+        # Depth-first walk with an explicit stack of (node, code, depth)
+        stack = [(self, 0, 0)]
+        while stack:
+            node, code, depth = stack.pop()
+            if node.char is not None:
+                codebook[node.char] = (code, depth)
+                continue
+            if node.right:
+                stack.append((node.right, (code << 1) | 1, depth + 1))
+            if node.left:
+                stack.append((node.left, code << 1, depth + 1))
+
+    def _check_encodable(self, text):
+        cache = self._cache
+        if cache.keyset is None:
+            cache.keyset = frozenset(cache.codebook)
+        # issuperset scans text in C and stops at the first unknown character
+        if not cache.keyset.issuperset(text):
+            missing_chars = set(text) - cache.keyset
+            raise ValueError(f"Characters not in tree: {missing_chars}")
 
     def encode(self, text):
-        missing_chars = set(text) - set(self.codebook.keys())
-        if missing_chars:
-            raise ValueError(f"Characters not in tree: {missing_chars}")
-        encoded = "".join(self.codebook[c] for c in text)
-        return encoded
+        self._check_encodable(text)
+        cache = self._cache
+        if cache.encode_table is None:
+            cache.encode_table = self.codebook_str
+        # map() keeps the lookups in C, and works for any sequence of symbols
+        return "".join(map(cache.encode_table.__getitem__, text))
+
+    def encode_bytes(self, text):
+        """
+        Encode text as a packed bit stream, most significant bit first.
+
+        Returns:
+            tuple: (bytes, bitlen) - the last byte is zero padded
+        """
+        if isinstance(text, str) and len(text) >= NUMBA_ENCODE_MIN_LEN:
+            tables = self._numba_tables()
+            if tables:
+                self._check_encodable(text)
+                code_ints, code_lens, _ = tables
+                np = _import_optional("numpy")
+                _encode_numba, _ = _numba_codec()
+                codepoints = np.frombuffer(
+                    text.encode("utf-32-le", "surrogatepass"), dtype=np.uint32
+                )
+                bitlen = int(code_lens[codepoints].sum())
+                out = _encode_numba(codepoints, code_ints, code_lens, bitlen)
+                return out.tobytes(), bitlen
+
+        # A fixed number of C-level passes and allocations: the bit string,
+        # one int parsed from it, and the output bytes.
+        encoded = self.encode(text)
+        return _pack_bits(encoded), len(encoded)
+
+    def _build_decode_table(self):
+        """
+        Build a lookup table indexed by the next `table_bits` bits of input,
+        with table_bits = min(longest code, DECODE_TABLE_BITS).
+        """
+        max_len = max((length for _, length in self.codebook.values()), default=0)
+        table_bits = min(max_len, DECODE_TABLE_BITS)
+        flat = self._flatten()
+        table = self._lookup_table(table_bits, flat)
+        self._cache.decode_table = (table, table_bits, max_len, flat)
+
+    def _lookup_table(self, table_bits, flat):
+        """
+        Entries are (symbol, length) for codes that fit in the table, and
+        (None, node_id) for prefixes of longer codes, where node_id is the
+        flattened subtree reached after `table_bits` bits. Unused entries
+        are (None, -1).
+        """
+        left, right, _ = flat
+        table = [(None, -1)] * (1 << table_bits)
+        for symbol, (code, length) in self.codebook.items():
+            if length <= table_bits:
+                shift = table_bits - length
+                start = code << shift
+                table[start : start + (1 << shift)] = [(symbol, length)] * (1 << shift)
+            else:
+                prefix = code >> (length - table_bits)
+                if table[prefix][1] < 0:
+                    node_id = 0
+                    for i in range(table_bits - 1, -1, -1):
+                        node_id = right[node_id] if (prefix >> i) & 1 else left[node_id]
+                    table[prefix] = (None, node_id)
+        return table
+
+    def _build_multi_table(self):
+        """
+        Build a DECODE_TABLE_BITS wide table like _lookup_table, but where the
+        first code leaves room, entries hold all the complete codes in those
+        bits, e.g. ("abc", 9), so one lookup can decode several symbols.
+        """
+        table, table_bits, _, flat = self._cache.decode_table
+        if table_bits < DECODE_TABLE_BITS:
+            table_bits = DECODE_TABLE_BITS
+            table = self._lookup_table(table_bits, flat)
+        mask = (1 << table_bits) - 1
+        multi = table[:]
+        for i, (symbols, length) in enumerate(table):
+            if symbols is None:
+                continue
+            while length < table_bits:
+                # the next code must fit in the bits that remain after length
+                symbol, next_length = table[(i << length) & mask]
+                if symbol is None or length + next_length > table_bits:
+                    break
+                symbols += symbol
+                length += next_length
+            multi[i] = (symbols, length)
+        self._cache.multi_table = (multi, table_bits)
+
+    def _numba_tables(self):
+        """
+        Numpy arrays for the compiled codec, or False when it does not apply:
+        numba must be installed, symbols must be single characters and codes
+        at most NUMBA_MAX_CODE_LEN.
+
+        Returns:
+            tuple: (code_ints, code_lens) indexed by code point, and the
+            shortest code length
+        """
+        cache = self._cache
+        if cache.numba_tables is not None:
+            return cache.numba_tables
+        cache.numba_tables = False
+        codebook = cache.codebook
+        if _numba_codec() is None:
+            return False
+        if not codebook or not all(
+            isinstance(c, str) and len(c) == 1 for c in codebook
+        ):
+            return False
+        lengths = [length for _, length in codebook.values()]
+        if max(lengths) > NUMBA_MAX_CODE_LEN:
+            return False
+
+        np = _import_optional("numpy")
+        size = max(map(ord, codebook)) + 1
+        code_ints = np.zeros(size, np.int64)
+        code_lens = np.zeros(size, np.int64)
+        for c, (code, length) in codebook.items():
+            code_ints[ord(c)] = code
+            code_lens[ord(c)] = length
+        cache.numba_tables = (code_ints, code_lens, min(lengths))
+        return cache.numba_tables
+
+    def _numba_decode_tables(self):
+        """
+        The decode table and flattened tree as _decode_numba arguments, built
+        on first use so encode-only callers never pay for them.
+        """
+        cache = self._cache
+        if cache.numba_decode_tables is not None:
+            return cache.numba_decode_tables
+        if cache.decode_table is None:
+            self._build_decode_table()
+        table, table_bits, _, (left, right, symbol) = cache.decode_table
+        np = _import_optional("numpy")
+        table_sym = np.array([-1 if s is None else ord(s) for s, _ in table], np.int32)
+        table_len = np.array([length for _, length in table], np.int64)
+        cache.numba_decode_tables = (
+            table_sym,
+            table_len,
+            table_bits,
+            np.array(left, np.int64),
+            np.array(right, np.int64),
+            np.array([-1 if s is None else ord(s) for s in symbol], np.int32),
+        )
+        return cache.numba_decode_tables
+
+    def _flatten(self):
+        """
+        Flatten the tree into parallel lists (left, right, symbol) indexed by
+        node id in breadth-first order, with the root as node 0. Missing
+        children are -1 and internal nodes have symbol None.
+        """
+        left, right, symbol = [], [], []
+        nodes = [self]
+        for node in nodes:  # nodes grows while iterating - a BFS queue
+            symbol.append(node.char)
+            for child, child_ids in ((node.left, left), (node.right, right)):
+                if child is None:
+                    child_ids.append(-1)
+                else:
+                    child_ids.append(len(nodes))
+                    nodes.append(child)
+        return left, right, symbol
 
     def decode(self, encoded):
-        if not all(bit in "01" for bit in encoded):
+        if not set(encoded) <= {"0", "1"}:
             raise ValueError("Encoded string contains non-binary characters")
 
-        # Handle the edge case of a single-node tree (only one symbol)
-        if self.left is None and self.right is None:
-            if self.char is not None:
-                return self.char * len(encoded)
-            else:  # Should be impossible if tree is built correctly
-                return ""
+        if len(encoded) < TABLE_DECODE_MIN_BITS and self._cache.decode_table is None:
+            return self._decode_walk(encoded)
+        return self.decode_bytes(_pack_bits(encoded), len(encoded))
+
+    def decode_bytes(self, buf, bitlen):
+        """Decode the first `bitlen` bits of a packed bit stream, see encode_bytes."""
+        if bitlen < 0:
+            raise ValueError("bitlen must not be negative")
+        nbytes = (bitlen + 7) // 8
+        if len(buf) < nbytes:
+            raise ValueError("Encoded buffer is shorter than bitlen")
+        if bitlen == 0:
+            return ""
+        if bitlen < TABLE_DECODE_MIN_BITS and self._cache.decode_table is None:
+            bits = int.from_bytes(buf[:nbytes], "big") >> (8 * nbytes - bitlen)
+            return self._decode_walk(bin(bits)[2:].zfill(bitlen))
+        if bitlen >= NUMBA_DECODE_MIN_BITS:
+            tables = self._numba_tables()
+            if tables:
+                np = _import_optional("numpy")
+                _, _decode_numba = _numba_codec()
+                # no more symbols than bits per shortest code
+                out = np.empty(bitlen // tables[2], np.int32)
+                buf = np.frombuffer(buf, np.uint8, count=nbytes)
+                n = _decode_numba(buf, bitlen, *self._numba_decode_tables(), out)
+                if n == -1:
+                    raise ValueError("Invalid encoded string")
+                if n == -2:
+                    raise ValueError("Incomplete encoded string - ended mid-traversal")
+                return (
+                    out[:n]
+                    .astype(np.uint32)
+                    .tobytes()
+                    .decode("utf-32-le", "surrogatepass")
+                )
+
+        cache = self._cache
+        if cache.decode_table is None:
+            self._build_decode_table()
+        table, table_bits, max_len, flat = cache.decode_table
+        if bitlen >= MULTI_DECODE_MIN_BITS:
+            if cache.multi_table is None:
+                self._build_multi_table()
+            fast, fast_bits = cache.multi_table
+        else:
+            fast, fast_bits = table, table_bits
+        # bits needed in the window for any lookup, including long codes
+        lookahead = max(max_len, fast_bits)
+
+        result = []
+        append = result.append
+        window = 0  # undecoded bits, most significant first
+        avail = 0  # number of undecoded bits at the bottom of window
+        pad = 0  # zero bits appended after the end of input
+        pos = 0
+        while pos < nbytes:
+            chunk = buf[pos : min(pos + 64, nbytes)]
+            pos += len(chunk)
+            window = ((window & ((1 << avail) - 1)) << (8 * len(chunk))) | (
+                int.from_bytes(chunk, "big")
+            )
+            avail += 8 * len(chunk)
+            if pos < nbytes:
+                lookup, bits = fast, fast_bits
+                limit = lookahead
+            else:
+                # Drop the padding of the last byte and append lookahead zero
+                # bits, so the final codes can be looked up like all the others.
+                pad = lookahead
+                window = (window >> (8 * nbytes - bitlen)) << pad
+                avail += pad - (8 * nbytes - bitlen)
+                # one symbol per lookup, so codes never run into the padding
+                lookup, bits = table, table_bits
+                limit = pad + 1
+            mask = (1 << bits) - 1
+
+            # avail >= limit guarantees a full table index and enough bits
+            # for the longest code, so the hot loop needs no bounds checks
+            while avail >= limit:
+                symbol, length = lookup[(window >> (avail - bits)) & mask]
+                if symbol is None:
+                    symbol, length = self._decode_long(
+                        window, avail, length, bits, flat
+                    )
+                    if symbol is None:
+                        # leaving the tree in the padding means a truncated code
+                        if length > avail - pad:
+                            raise ValueError(
+                                "Incomplete encoded string - ended mid-traversal"
+                            )
+                        raise ValueError("Invalid encoded string")
+                append(symbol)
+                avail -= length
+
+        if avail < pad:
+            raise ValueError("Incomplete encoded string - ended mid-traversal")
+        return "".join(result)
+
+    def _decode_walk(self, bits):
+        """Decode a short string of "0"/"1" by walking the tree bit by bit."""
+        if self.char is not None:
+            # single symbol tree, coded as "0"
+            if "1" in bits:
+                raise ValueError("Invalid encoded string")
+            return "".join([self.char] * len(bits))
 
         result = []
+        append = result.append
         node = self
-        for bit in encoded:
+        for bit in bits:
             node = node.left if bit == "0" else node.right
             if node is None:
                 raise ValueError("Invalid encoded string")
             if node.char is not None:
-                result.append(node.char)
+                append(node.char)
                 node = self
-
-        if node != self:
+        if node is not self:
             raise ValueError("Incomplete encoded string - ended mid-traversal")
-
         return "".join(result)
 
+    @staticmethod
+    def _decode_long(window, avail, node_id, length, flat):
+        """
+        Finish a code longer than the decode table by walking the flat tree.
+        For an unused table entry (node_id -1) the walk starts at the root.
+
+        Returns:
+            tuple: (symbol, length), or (None, length) if the walk left the
+            tree at bit `length`
+        """
+        left, right, symbol = flat
+        if node_id < 0:
+            node_id, length = 0, 0
+        while True:
+            length += 1
+            if (window >> (avail - length)) & 1:
+                node_id = right[node_id]
+            else:
+                node_id = left[node_id]
+            if node_id < 0:
+                return None, length
+            if symbol[node_id] is not None:
+                return symbol[node_id], length
+
     def total_weighted_code_length(self, freq_dict: dict) -> int:
         """Calculates the sum of (frequency * code_length) for all symbols."""
         if self.codebook is None:
             self.generate_codes()
 
-        return sum(freq_dict[c] * len(self.codebook[c]) for c in freq_dict)
+        return sum(freq_dict[c] * self.codebook[c][1] for c in freq_dict)
 
     def average_code_length(self, freq_dict: dict) -> float:
         """Calculates the average code length for a given frequency distribution."""
@@ -181,15 +775,45 @@ class HuffmanNode:
 
 
 def entropy(freq):
+    np = _import_optional("numpy") if len(freq) >= NUMPY_ENTROPY_MIN_LEN else None
+    if np is not None:
+        counts = np.fromiter(freq.values(), dtype=np.float64, count=len(freq))
+        N = counts.sum()
+        if N == 0:
+            return 0.0
+        p = counts[counts > 0] / N
+        return float(-np.sum(p * np.log2(p)))
+
     N = sum(freq.values())
     if N == 0:
         return 0.0
     return -sum((f / N) * math.log2(f / N) for f in freq.values() if f > 0)
 
 
+def fibonacci_freq(n, width=1):
+    """
+    Fibonacci frequencies for n symbols "a", "b", ..., each repeated `width`
+    times - the most skewed distribution, giving codes up to n - 1 bits long.
+    """
+    fib = [1, 1]
+    while len(fib) < n:
+        fib.append(fib[-1] + fib[-2])
+    return {chr(ord("a") + i) * width: f for i, f in enumerate(fib[:n])}
+
+
+def assert_rejected(root, buf, bitlen, message):
+    """Check that decode_bytes raises ValueError, with message in its text."""
+    try:
+        root.decode_bytes(buf, bitlen)
+    except ValueError as e:
+        assert message in str(e), e
+    else:
+        raise AssertionError(f"decode_bytes accepted {buf!r}, {bitlen}")
+
+
 def ex1(text):
     """Calculate symbol frequencies, and create Huffman encoding"""
-    freq = Counter(text)
+    freq = count_freq(text)
     root = HuffmanNode.from_freq(freq)
     encoded = root.encode(text)
     decoded = root.decode(encoded)
@@ -224,10 +848,9 @@ def ex2(text):
     print("Decoded:", decoded)
     assert text == decoded
 
-    lav = sum(freq[c] * len(root.codebook[c]) for c in freq)
     root.display_codes(freq)
     lav = root.average_code_length(freq)
-    print("Average code length: {lav}")
+    print(f"Average code length: {lav}")
     assert root.total_weighted_code_length(freq) == 342
 
 
@@ -283,7 +906,7 @@ def ex4():
     FREQ_MAC_KAY5_7 = {"a": 1, "b": 24, "c": 5, "d": 20, "e": 47, "f": 1, "g": 2}
     freq = FREQ_MAC_KAY5_7
     root = HuffmanNode.from_freq(freq)
-    symbols_with_lengths = [(c, len(v)) for c, v in root.codebook.items()]
+    symbols_with_lengths = [(c, length) for c, (_, length) in root.codebook.items()]
     codes = canonical_huffman_codes(symbols_with_lengths)
     root = HuffmanNode.from_codebook(codes)
     root.display_codes(freq)
@@ -293,9 +916,73 @@ def ex4():
     assert root.total_weighted_code_length(freq) == 197
 
 
-if __name__ == "__main__":
-    import sys
+def ex6(text):
+    """Encode into packed bytes and back, and reject malformed bit streams"""
+    root = HuffmanNode.from_freq(count_freq(text))
+    buf, bitlen = root.encode_bytes(text)
+    decoded = root.decode_bytes(buf, bitlen)
+    print(f"Packed {len(text)} symbols into {len(buf)} bytes ({bitlen} bits)")
+    assert len(buf) == (bitlen + 7) // 8
+    assert text == decoded
+
+    assert_rejected(root, buf[:-1], bitlen, "shorter than bitlen")
+    assert_rejected(root, b"\xff", -5, "negative")
+    # First walking the tree, then again once a long stream has built the
+    # decode table, which short streams use from then on.
+    root = HuffmanNode.from_codebook({"a": "0", "b": "10"})  # "11" is unused
+    for _ in range(2):
+        assert_rejected(root, bytes([0b10000000]), 1, "Incomplete")
+        assert_rejected(root, bytes([0b11000000]), 2, "Invalid")
+        assert root.decode("0" * TABLE_DECODE_MIN_BITS) == "a" * TABLE_DECODE_MIN_BITS
+    # "110" stops inside "01", although "0" + zero padding would be unused
+    root = HuffmanNode.from_codebook({"a": "1", "b": "01"})
+    for _ in range(2):
+        assert_rejected(root, bytes([0b11000000]), 3, "Incomplete")
+        assert root.decode("1" * TABLE_DECODE_MIN_BITS) == "a" * TABLE_DECODE_MIN_BITS
+
+
+def ex7():
+    """Skewed (Fibonacci) frequencies give codes longer than the decode table"""
+    freq = fibonacci_freq(20)
+    root = HuffmanNode.from_freq(freq)
+    max_len = max(length for _, length in root.codebook.values())
+    print(f"Longest code: {max_len} bits")
+    assert max_len > DECODE_TABLE_BITS
+
+    text = "".join(c * f for c, f in freq.items())
+    assert root.decode(root.encode(text)) == text
+    assert root.decode_bytes(*root.encode_bytes(text)) == text
 
+
+def ex8():
+    """Long texts take the numpy path in count_freq, if numpy is installed"""
+    text = ("huffman \U0001f600 " * NUMPY_MIN_LEN)[:NUMPY_MIN_LEN]
+    freq = count_freq(text)
+    assert isinstance(freq, Counter)
+    assert freq == Counter(text)
+    tokens = text.split()
+    assert count_freq(tokens) == Counter(tokens)
+
+
+def ex9():
+    """
+    Long streams take the multi-symbol table. Two-character symbols keep
+    decode_bytes on the pure Python path even when numba is installed.
+    """
+    freq = fibonacci_freq(20, width=2)
+    root = HuffmanNode.from_freq(freq)
+    assert max(length for _, length in root.codebook.values()) > DECODE_TABLE_BITS
+
+    # end on the rarest symbol, so the stream ends with a long code
+    symbols = [s for s, f in reversed(freq.items()) for _ in range(2 * f)]
+    buf, bitlen = root.encode_bytes(symbols)
+    print(f"Packed {len(symbols)} two-character symbols into {bitlen} bits")
+    assert bitlen >= MULTI_DECODE_MIN_BITS
+    assert root.decode_bytes(buf, bitlen) == "".join(symbols)
+    assert_rejected(root, buf, bitlen - 1, "Incomplete")
+
+
+if __name__ == "__main__":
     if len(sys.argv) > 1 and sys.argv[1] == "test":
         ex1("this is an example of huffman encoding")
         ex1("abbcccdddd")
@@ -303,13 +990,17 @@ if __name__ == "__main__":
         ex3()
         ex4()
         ex5()
+        ex6("this is an example of huffman encoding")
+        ex7()
+        ex8()
+        ex9()
     else:
         while True:
             print("\nInput a text to be Huffman encoded:")
             text = input()
             if text == "":
                 break
-            freq = Counter(text)
+            freq = count_freq(text)
             root = HuffmanNode.from_freq(freq)
             encoded = root.encode(text)
             print("Encoded:", encoded)